@@ -2,108 +2,75 @@
 # Exposes /api/send to allow two clients to chat through the relay network
 # Returns relay hops, layers, and step-by-step details for visualization
 
+# eventlet gives Socket.IO real WebSocket transport; it must patch the stdlib
+# before socket/threading/sqlite3 are imported. Fall back to threads without it.
+try:
+    import eventlet
+    eventlet.monkey_patch()
+    ASYNC_MODE = 'eventlet'
+except ImportError:
+    ASYNC_MODE = 'threading'
+
 from flask import Flask, request, jsonify
+from flask.json.provider import DefaultJSONProvider
 from flask_cors import CORS
 import subprocess
-import json
 import os
-import base64
-import re
 from datetime import datetime
 import threading
+import queue
+from contextlib import contextmanager
+import time
 import sqlite3
 from flask_socketio import SocketIO, emit
 import socket
-from signal import SIGTERM
 import psutil
+import hmac
+from argon2 import PasswordHasher
+from argon2.exceptions import VerificationError, InvalidHashError
+from concurrent.futures import ThreadPoolExecutor, Future
+from client import send_message, CLIENT_TIMEOUT
+from net_utils import send_frame, recv_frame, MAX_CELL_SIZE, json_dumps, json_loads, orjson
+
+class OrjsonProvider(DefaultJSONProvider):
+    """Route jsonify() and request.json through orjson."""
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
 
 app = Flask(__name__)
+if orjson:
+    app.json = OrjsonProvider(app)
 CORS(app)
-socketio = SocketIO(app, cors_allowed_origins="*")
-
-# Simulate or connect to your real relay logic here
-# For now, we'll mock the relay process for visualization
-
-def onion_layers(message):
-    # Simulate 3 layers of encryption (base64 for demo)
-    k1 = base64.b64encode((message + ' [K1]').encode()).decode()
-    k2 = base64.b64encode((k1 + ' [K2]').encode()).decode()
-    k3 = base64.b64encode((k2 + ' [K3]').encode()).decode()
-    return [k3, k2, k1]
-
-def relay_steps(sender, recipient, message):
-    layers = onion_layers(message)
-    hops = [sender, 'Relay 1', 'Relay 2', 'Relay 3', recipient]
-    layer_labels = [
-        f"Layer 3 (Relay 1): {layers[0]}",
-        f"Layer 2 (Relay 2): {layers[1]}",
-        f"Layer 1 (Relay 3): {layers[2]}",
-        f"Destination: {message}",
-        ""
-    ]
-    steps = [
-        "Client wraps the message in 3 layers of encryption (K3, K2, K1).",
-        "Relay 1 removes the outermost layer (K3).",
-        "Relay 2 removes the next layer (K2).",
-        "Relay 3 removes the last layer (K1).",
-        "Message delivered to recipient."
-    ]
-    return {
-        'hops': hops,
-        'layers': layer_labels,
-        'steps': steps
-    }
+socketio = SocketIO(app, cors_allowed_origins="*", async_mode=ASYNC_MODE)
+
+client_executor = ThreadPoolExecutor(max_workers=4)
 
 def call_tor_client_backend(sender, recipient, message, relay_count=3):
-    import re
     # Ensure relay_count is an int
     try:
         relay_count = int(relay_count)
     except Exception:
         relay_count = 3
-    msg_json = json.dumps({"from": sender, "to": recipient, "text": message})
+    msg_json = json_dumps({"from": sender, "to": recipient, "text": message}).decode()
     dest_ip = "127.0.0.1"
     dest_port = 9100
     try:
-        proc = subprocess.Popen([
-            "python3", "client.py", dest_ip, str(dest_port), msg_json, "--path_length", str(relay_count)
-        ], stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=os.path.dirname(__file__))
-        out, err = proc.communicate(timeout=10)
-        logs = out.decode(errors="ignore") + err.decode(errors="ignore")
-        print("[API DEBUG] --- FULL CLIENT LOGS START ---")
-        print(logs)
-        print("[API DEBUG] --- FULL CLIENT LOGS END ---")
-        relay_pattern = re.compile(r"Relay ([\d\.]+):(\d+) public key fingerprint")
-        full_hops = []
-        for match in relay_pattern.finditer(logs):
-            ip, port = match.groups()
-            full_hops.append(f"{ip}:{port}")
-        print(f"[API DEBUG] Parsed relay path: {full_hops}")
-        if not full_hops:
-            print("[API WARNING] No relays parsed from logs, using fallback placeholder relays.")
-            try:
-                from cds import get_all_relays
-                relays = get_all_relays()
-                full_hops = [f"{r['ip']}:{r['port']}" for r in relays][:relay_count]
-            except Exception as e:
-                print(f"[API ERROR] Could not get relays from CDS: {e}")
-                full_hops = ["Relay 1", "Relay 2", "Relay 3"][:relay_count]
-        layers = []
-        steps = []
-        for line in logs.splitlines():
-            if "Layer" in line and "relay" in line:
-                layers.append(line.strip())
-            if "decrypted" in line or "decoded" in line:
-                steps.append(line.strip())
-        if not layers:
-            layers = ["Layer 3", "Layer 2", "Layer 1", "Destination", ""]
-        if not steps:
-            steps = ["Message sent through relays."]
+        # Run the client in-process on a worker thread; this request still waits for it,
+        # but gives up after CLIENT_TIMEOUT instead of hanging on a stalled circuit
+        future = client_executor.submit(send_message, dest_ip, dest_port, msg_json, relay_count)
+        result = future.result(timeout=CLIENT_TIMEOUT)
+        full_hops = result['hops']
+        print(f"[API DEBUG] Relay path: {full_hops}")
+        layers = result['layers'] or ["Layer 3", "Layer 2", "Layer 1", "Destination", ""]
+        steps = result['steps'] or ["Message sent through relays."]
         return {
             'hops': full_hops,
             'layers': layers,
             'steps': steps,
-            'logs': logs
+            'response': result['response'] or ''
         }
     except Exception as e:
         print(f"[API ERROR] Exception in call_tor_client_backend: {e}")
@@ -111,22 +78,48 @@ def call_tor_client_backend(sender, recipient, message, relay_count=3):
             'hops': [f"Relay {i+1}" for i in range(relay_count)],
             'layers': ["Layer 3", "Layer 2", "Layer 1", "Destination", ""],
             'steps': [f"Error: {str(e)}"],
-            'logs': str(e)
+            'response': ''
         }
 
 DB_PATH = os.path.join(os.path.dirname(__file__), 'chat.db')
 
+def connect_db():
+    """Open an autocommit connection with the per-connection pragmas applied."""
+    conn = sqlite3.connect(DB_PATH, check_same_thread=False, isolation_level=None)
+    conn.execute('PRAGMA synchronous=NORMAL')  # safe under WAL, fsyncs only at checkpoints
+    conn.execute('PRAGMA cache_size=-20000')   # ~20 MB page cache
+    conn.execute('PRAGMA temp_store=MEMORY')
+    conn.execute('PRAGMA mmap_size=268435456')
+    conn.row_factory = sqlite3.Row
+    return conn
+
+# Long-lived connections shared by all request threads: one writer guarded by
+# db_lock (SQLite allows a single writer anyway) plus a pool of read-only
+# connections, which WAL lets run concurrently with the writer.
+DB_READ_POOL_SIZE = 4
+db_conn = connect_db()
+db_lock = threading.Lock()
+db_read_pool = queue.Queue()
+
+@contextmanager
+def read_conn():
+    conn = db_read_pool.get()
+    try:
+        yield conn
+    finally:
+        db_read_pool.put(conn)
+
 def init_db():
-    with sqlite3.connect(DB_PATH) as conn:
-        c = conn.cursor()
-        c.execute('''CREATE TABLE IF NOT EXISTS users (
+    with db_lock:
+        db_conn.execute('PRAGMA journal_mode=WAL')  # persistent: stored in the database file
+        db_conn.execute('''CREATE TABLE IF NOT EXISTS users (
             username TEXT PRIMARY KEY,
             password TEXT,
             avatar TEXT,
             online INTEGER,
             last_seen TEXT
         )''')
-        c.execute('''CREATE TABLE IF NOT EXISTS messages (
+        db_conn.execute('''CREATE TABLE IF NOT EXISTS messages (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             sender TEXT,
             recipient TEXT,
@@ -136,94 +129,255 @@ def init_db():
             read INTEGER DEFAULT 0,
             relay_path TEXT
         )''')
-        conn.commit()
+        # sender/recipient lookups and the monitor's latest-messages query; SQLite
+        # answers get_conversations' OR with a multi-index union over the first two
+        db_conn.execute('CREATE INDEX IF NOT EXISTS idx_messages_pair_time ON messages(sender, recipient, timestamp)')
+        db_conn.execute('CREATE INDEX IF NOT EXISTS idx_messages_recipient_read ON messages(recipient, read)')
+        # Partial index holding only unread rows: makes the mark-read probe index-only
+        db_conn.execute('CREATE INDEX IF NOT EXISTS idx_messages_unread_pair ON messages(sender, recipient) WHERE read=0')
+        db_conn.execute('CREATE INDEX IF NOT EXISTS idx_messages_timestamp ON messages(timestamp)')
 init_db()
+for _ in range(DB_READ_POOL_SIZE):
+    reader = connect_db()
+    reader.execute('PRAGMA query_only=ON')
+    db_read_pool.put(reader)
 
 # --- DB helper functions ---
 def get_user(username):
-    with sqlite3.connect(DB_PATH) as conn:
-        c = conn.cursor()
-        c.execute('SELECT username, password, avatar, online, last_seen FROM users WHERE username=?', (username,))
-        row = c.fetchone()
-        if row:
-            return dict(zip(['username', 'password', 'avatar', 'online', 'last_seen'], row))
-        return None
+    with read_conn() as conn:
+        row = conn.execute('SELECT username, password, avatar, online, last_seen FROM users WHERE username=?', (username,)).fetchone()
+    return dict(row) if row else None
 
 def set_user_online(username, online):
-    with sqlite3.connect(DB_PATH) as conn:
-        c = conn.cursor()
-        c.execute('UPDATE users SET online=?, last_seen=datetime("now") WHERE username=?', (int(online), username))
-        conn.commit()
+    with db_lock:
+        db_conn.execute('UPDATE users SET online=?, last_seen=datetime("now") WHERE username=?', (int(online), username))
+    invalidate_users_cache()
 
 def add_user(username, password, avatar=None):
-    with sqlite3.connect(DB_PATH) as conn:
-        c = conn.cursor()
-        c.execute('INSERT INTO users (username, password, avatar, online, last_seen) VALUES (?, ?, ?, 1, datetime("now"))', (username, password, avatar or ''))
-        conn.commit()
+    with db_lock:
+        db_conn.execute('INSERT INTO users (username, password, avatar, online, last_seen) VALUES (?, ?, ?, 1, datetime("now"))', (username, password, avatar or ''))
+    invalidate_users_cache()
+
+def set_user_password(username, password_hash):
+    with db_lock:
+        db_conn.execute('UPDATE users SET password=? WHERE username=?', (password_hash, username))
 
 def get_all_users():
-    with sqlite3.connect(DB_PATH) as conn:
-        c = conn.cursor()
-        c.execute('SELECT username, avatar, online FROM users')
-        return [{'username': u, 'avatar': a, 'online': bool(o)} for u, a, o in c.fetchall()]
-
-def add_message(sender, recipient, text, relay_path=None):
-    with sqlite3.connect(DB_PATH) as conn:
-        c = conn.cursor()
-        c.execute('INSERT INTO messages (sender, recipient, text, timestamp, relay_path) VALUES (?, ?, ?, datetime("now"), ?)', (sender, recipient, text, json.dumps(relay_path) if relay_path else None))
-        conn.commit()
-
-def get_conversations(username):
-    with sqlite3.connect(DB_PATH) as conn:
-        c = conn.cursor()
-        c.execute('SELECT sender, recipient, text, timestamp, delivered, read FROM messages WHERE sender=? OR recipient=? ORDER BY timestamp', (username, username))
-        return [dict(zip(['from', 'to', 'text', 'timestamp', 'delivered', 'read'], row)) for row in c.fetchall()]
-
-def mark_messages_delivered(sender, recipient):
-    with sqlite3.connect(DB_PATH) as conn:
-        c = conn.cursor()
-        c.execute('UPDATE messages SET delivered=1 WHERE sender=? AND recipient=?', (sender, recipient))
-        conn.commit()
+    with read_conn() as conn:
+        rows = conn.execute('SELECT username, avatar, online FROM users').fetchall()
+    return [{'username': u, 'avatar': a, 'online': bool(o)} for u, a, o in rows]
+
+USERS_CACHE_TTL = 0.5  # seconds; add_user/set_user_online invalidate immediately
+users_cache = {'ts': 0.0, 'users': [], 'version': 0}
+
+def invalidate_users_cache():
+    users_cache['version'] += 1
+    users_cache['ts'] = 0.0
+
+def get_all_users_cached():
+    """get_all_users() memoized for the monitor and /api/users, which every client polls."""
+    now = time.monotonic()
+    if now - users_cache['ts'] >= USERS_CACHE_TTL:
+        version = users_cache['version']
+        users_cache['users'] = get_all_users()
+        # An invalidation that raced the query leaves the result marked stale
+        if users_cache['version'] == version:
+            users_cache['ts'] = now
+    return users_cache['users']
+
+def encode_relay_path(relay_path):
+    # Hops are plain "ip:port" strings, so a newline-joined column needs no JSON
+    return '\n'.join(relay_path) if relay_path else None
+
+def decode_relay_path(value):
+    if not value:
+        return None
+    if value.startswith('['):  # rows written before the newline format
+        return json_loads(value)
+    return value.split('\n')
+
+def add_message(sender, recipient, text, relay_path=None, delivered=False):
+    """Insert a message. Messages routed synchronously are stored as delivered."""
+    with db_lock:
+        db_conn.execute('INSERT INTO messages (sender, recipient, text, timestamp, delivered, relay_path) VALUES (?, ?, ?, datetime("now"), ?, ?)', (sender, recipient, text, int(delivered), encode_relay_path(relay_path)))
+
+CONVERSATION_PAGE_SIZE = 200
+
+def get_conversations(username, peer=None, limit=CONVERSATION_PAGE_SIZE, offset=0):
+    """Return the user's newest `limit` messages (skipping `offset`), oldest first.
+
+    With `peer`, only the conversation between the two users is paged, so a busy
+    chat with someone else can't push an older conversation out of the page.
+    """
+    if peer:
+        where, params = '(sender=? AND recipient=?) OR (sender=? AND recipient=?)', (username, peer, peer, username)
+    else:
+        where, params = 'sender=? OR recipient=?', (username, username)
+    with read_conn() as conn:
+        rows = conn.execute(f'''SELECT "from", "to", text, timestamp, delivered, read FROM (
+            SELECT id, sender AS "from", recipient AS "to", text, timestamp, delivered, read FROM messages
+            WHERE {where} ORDER BY timestamp DESC, id DESC LIMIT ? OFFSET ?
+        ) ORDER BY timestamp, id''', (*params, limit, offset)).fetchall()
+    return [dict(row) for row in rows]
+
+def get_unread_counts(username):
+    """Map each sender to the number of unread messages they sent to username."""
+    with read_conn() as conn:
+        rows = conn.execute('SELECT sender, COUNT(*) FROM messages WHERE recipient=? AND read=0 GROUP BY sender', (username,)).fetchall()
+    return {sender: count for sender, count in rows}
+
+# Read-marks are group-committed: callers queue a (sender, recipient) pair and
+# wait, while one writer task folds everything queued meanwhile into a single
+# transaction, so a burst of chat opens costs one commit instead of one each.
+read_marks = queue.Queue()
 
 def mark_messages_read(sender, recipient):
-    with sqlite3.connect(DB_PATH) as conn:
-        c = conn.cursor()
-        c.execute('UPDATE messages SET read=1 WHERE sender=? AND recipient=?', (sender, recipient))
-        conn.commit()
+    """Mark sender's messages to recipient as read; returns once committed."""
+    # The UI re-marks already-read chats constantly; skip the write entirely then
+    with read_conn() as conn:
+        if conn.execute('SELECT 1 FROM messages WHERE sender=? AND recipient=? AND read=0 LIMIT 1', (sender, recipient)).fetchone() is None:
+            return
+    done = Future()
+    read_marks.put((sender, recipient, done))
+    done.result()
+
+def flush_read_marks():
+    while True:
+        batch = [read_marks.get()]
+        while True:
+            try:
+                batch.append(read_marks.get_nowait())
+            except queue.Empty:
+                break
+        pairs = list(dict.fromkeys((sender, recipient) for sender, recipient, _ in batch))
+        error = None
+        with db_lock:
+            try:
+                db_conn.execute('BEGIN IMMEDIATE')
+                db_conn.executemany('UPDATE messages SET read=1 WHERE sender=? AND recipient=? AND read=0', pairs)
+                db_conn.execute('COMMIT')
+            except sqlite3.Error as e:
+                if db_conn.in_transaction:
+                    db_conn.execute('ROLLBACK')
+                error = e
+        for _, _, done in batch:
+            if error is None:
+                done.set_result(None)
+            else:
+                done.set_exception(error)
+
+socketio.start_background_task(flush_read_marks)
 
 # --- Relay and Server Management Endpoints ---
+# One psutil pass is shared by every lookup for PROCESS_SCAN_TTL; the monitor
+# alone used to walk every PID once per relay plus twice more.
+PROCESS_SCAN_TTL = 1.0
+process_cache = {'ts': 0.0, 'snapshot': None}
+process_cache_lock = threading.Lock()
+
+def scan_processes():
+    """Index relay, destination server and CDS PIDs from a single process_iter pass."""
+    with process_cache_lock:
+        now = time.monotonic()
+        if process_cache['snapshot'] is None or now - process_cache['ts'] >= PROCESS_SCAN_TTL:
+            relays = {}
+            dest_pid = cds_pid = None
+            for proc in psutil.process_iter(['pid', 'cmdline']):
+                cmd = proc.info['cmdline']
+                if not cmd:
+                    continue
+                if 'relay.py' in cmd:
+                    # relay.py <relay_id> <port>: read the port positionally so
+                    # other argv strings (e.g. the relay id) can't be mistaken for it.
+                    i = cmd.index('relay.py')
+                    if i + 2 < len(cmd):
+                        relays.setdefault(cmd[i + 2], proc.pid)
+                if dest_pid is None and 'dest_server.py' in cmd:
+                    dest_pid = proc.pid
+                if cds_pid is None and 'cds.py' in cmd:
+                    cds_pid = proc.pid
+            process_cache['snapshot'] = {'relays': relays, 'dest': dest_pid, 'cds': cds_pid}
+            process_cache['ts'] = now
+        return process_cache['snapshot']
+
+def invalidate_process_cache():
+    """Force the next lookup to rescan, e.g. after starting or stopping a process."""
+    process_cache['snapshot'] = None
+
 def find_relay_process_by_port(port):
     """Find PID of relay.py process with the given port as argument."""
-    for proc in psutil.process_iter(['pid', 'cmdline']):
-        try:
-            cmd = proc.info['cmdline']
-            if cmd and 'relay.py' in cmd and str(port) in cmd:
-                return proc.pid
-        except Exception:
-            continue
-    return None
+    return scan_processes()['relays'].get(str(port))
 
 def find_destination_server_process():
     """Find PID of dest_server.py process."""
-    for proc in psutil.process_iter(['pid', 'cmdline']):
-        try:
-            cmd = proc.info['cmdline']
-            if cmd and 'dest_server.py' in cmd:
-                return proc.pid
-        except Exception:
-            continue
-    return None
+    return scan_processes()['dest']
 
 def find_cds_process():
     """Find PID of cds.py process."""
-    for proc in psutil.process_iter(['pid', 'cmdline']):
+    return scan_processes()['cds']
+
+# Popen handles for the processes this server started, keyed 'relay:<port>',
+# 'dest' or 'cds'. They answer start/stop checks without a process scan; the
+# find_* helpers remain the fallback for processes left over from an earlier run.
+owned_procs = {}
+owned_procs_lock = threading.Lock()
+
+def owned_process(name):
+    """Return the Popen for name if we started it and it is still running."""
+    with owned_procs_lock:
+        proc = owned_procs.get(name)
+        if proc is not None and proc.poll() is not None:
+            del owned_procs[name]  # exited on its own
+            proc = None
+    return proc
+
+def spawn_process(name, args):
+    proc = subprocess.Popen(['python3', *args], cwd=os.path.dirname(__file__))
+    with owned_procs_lock:
+        owned_procs[name] = proc
+    invalidate_process_cache()
+    return proc
+
+STOP_TIMEOUT = 3  # seconds to wait after SIGTERM before escalating to SIGKILL
+
+def stop_process(name, pid):
+    """Stop name's process and wait for it to exit, so a following start never sees it.
+
+    Owned processes are signalled through their Popen handle so a reused PID is never hit.
+    """
+    with owned_procs_lock:
+        proc = owned_procs.pop(name, None)
+    try:
+        if proc is not None:
+            proc.terminate()
+            try:
+                proc.wait(timeout=STOP_TIMEOUT)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+                proc.wait()
+        else:
+            proc = psutil.Process(pid)
+            proc.terminate()
+            if not wait_for_exit(proc, STOP_TIMEOUT):
+                proc.kill()
+                wait_for_exit(proc, STOP_TIMEOUT)
+    except psutil.NoSuchProcess:
+        pass  # exited between the lookup and the signal
+    finally:
+        invalidate_process_cache()
+
+def wait_for_exit(proc, timeout):
+    """Poll a process we did not spawn until it is gone; psutil's own wait() needs
+    select.poll, which eventlet's monkey patching removes."""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
         try:
-            cmd = proc.info['cmdline']
-            if cmd and 'cds.py' in cmd:
-                return proc.pid
-        except Exception:
-            continue
-    return None
+            if proc.status() == psutil.STATUS_ZOMBIE:
+                return True
+        except psutil.NoSuchProcess:
+            return True
+        time.sleep(0.05)
+    return False
 
 @app.route('/api/relay/start', methods=['POST'])
 def start_relay():
@@ -233,12 +387,10 @@ def start_relay():
     if not port:
         return jsonify({'success': False, 'error': 'Missing relay port'}), 400
     # Check if relay already running
-    if find_relay_process_by_port(port):
+    if owned_process(f'relay:{port}') or find_relay_process_by_port(port):
         return jsonify({'success': False, 'error': f'Relay already running on port {port}'}), 400
     try:
-        proc = subprocess.Popen([
-            'python3', 'relay.py', str(relay_id), str(port)
-        ], cwd=os.path.dirname(__file__))
+        proc = spawn_process(f'relay:{port}', ['relay.py', str(relay_id), str(port)])
         return jsonify({'success': True, 'pid': proc.pid})
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
@@ -247,57 +399,56 @@ def start_relay():
 def stop_relay():
     data = request.json
     port = data.get('port')
-    pid = find_relay_process_by_port(port)
+    proc = owned_process(f'relay:{port}')
+    pid = proc.pid if proc else find_relay_process_by_port(port)
     if not pid:
         return jsonify({'success': False, 'error': 'Relay not running or unknown port'}), 404
     try:
-        os.kill(pid, SIGTERM)
+        stop_process(f'relay:{port}', pid)
         return jsonify({'success': True})
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
 
 @app.route('/api/destination/start', methods=['POST'])
 def start_destination():
-    if find_destination_server_process():
+    if owned_process('dest') or find_destination_server_process():
         return jsonify({'success': False, 'error': 'Destination server already running'}), 400
     try:
-        proc = subprocess.Popen([
-            'python3', 'dest_server.py'
-        ], cwd=os.path.dirname(__file__))
+        proc = spawn_process('dest', ['dest_server.py'])
         return jsonify({'success': True, 'pid': proc.pid})
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
 
 @app.route('/api/destination/stop', methods=['POST'])
 def stop_destination():
-    pid = find_destination_server_process()
+    proc = owned_process('dest')
+    pid = proc.pid if proc else find_destination_server_process()
     if not pid:
         return jsonify({'success': False, 'error': 'Destination server not running'}), 404
     try:
-        os.kill(pid, SIGTERM)
+        stop_process('dest', pid)
         return jsonify({'success': True})
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
 
 @app.route('/api/cds/start', methods=['POST'])
 def start_cds():
-    if find_cds_process():
+    if owned_process('cds') or find_cds_process():
         return jsonify({'success': False, 'error': 'CDS already running'}), 400
     try:
-        proc = subprocess.Popen([
-            'python3', 'cds.py'
-        ], cwd=os.path.dirname(__file__))
+        proc = spawn_process('cds', ['cds.py'])
         return jsonify({'success': True, 'pid': proc.pid})
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
 
 @app.route('/api/cds/stop', methods=['POST'])
 def stop_cds():
-    pid = find_cds_process()
+    proc = owned_process('cds')
+    pid = proc.pid if proc else find_cds_process()
     if not pid:
         return jsonify({'success': False, 'error': 'CDS not running'}), 404
     try:
-        os.kill(pid, SIGTERM)
+        stop_process('cds', pid)
         return jsonify({'success': True})
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
@@ -308,6 +459,65 @@ def stop_api_server():
     os._exit(0)
     return jsonify({'success': True})
 
+# --- Authentication ---
+# Passwords are stored as argon2 hashes; plaintext rows from before hashing are
+# upgraded on their next successful login.
+password_hasher = PasswordHasher()
+
+def check_password(user, password):
+    """Verify password for user, upgrading plaintext or outdated hashes on success."""
+    stored = user['password'] or ''
+    if not password:
+        return False
+    if stored.startswith('$argon2'):
+        try:
+            password_hasher.verify(stored, password)
+        except (VerificationError, InvalidHashError):
+            return False
+        if not password_hasher.check_needs_rehash(stored):
+            return True
+    elif not hmac.compare_digest(stored.encode(), password.encode()):
+        return False  # accounts created before hashing still hold plaintext
+    set_user_password(user['username'], password_hasher.hash(password))
+    return True
+
+# --- Chat event batching ---
+# new_message/read_message broadcasts are coalesced for EVENT_FLUSH_INTERVAL and
+# sent as one 'events_batch' packet of [name, payload] pairs (socket.js replays
+# them as individual events), so a burst costs one frame per client, not one per event.
+EVENT_FLUSH_INTERVAL = 0.03  # seconds
+# The timer alone doesn't bound a burst: everything queued in one interval would
+# go out as a single frame. A full queue is flushed at once instead, keeping each
+# batch to a frame size clients handle comfortably.
+EVENT_BATCH_MAX = 140
+pending_events = []
+pending_events_lock = threading.Lock()
+event_flush_scheduled = False
+
+def queue_event(name, payload):
+    global event_flush_scheduled
+    batch = None
+    with pending_events_lock:
+        pending_events.append([name, payload])
+        if len(pending_events) >= EVENT_BATCH_MAX:
+            batch = pending_events[:]
+            pending_events.clear()
+        elif not event_flush_scheduled:
+            event_flush_scheduled = True
+            socketio.start_background_task(flush_events)
+    if batch:
+        socketio.start_background_task(socketio.emit, 'events_batch', batch)
+
+def flush_events():
+    global event_flush_scheduled
+    socketio.sleep(EVENT_FLUSH_INTERVAL)
+    with pending_events_lock:
+        batch = pending_events[:]
+        pending_events.clear()
+        event_flush_scheduled = False
+    if batch:
+        socketio.emit('events_batch', batch)
+
 # --- Replace in-memory endpoints with DB-backed versions ---
 @app.route('/api/register', methods=['POST'])
 def register():
@@ -317,9 +527,11 @@ def register():
     avatar = data.get('avatar')
     if not username or not password:
         return jsonify({'success': False, 'error': 'Missing username or password'})
+    if not isinstance(password, str):
+        return jsonify({'success': False, 'error': 'Password must be a string'})
     if get_user(username):
         return jsonify({'success': False, 'error': 'Username already exists'})
-    add_user(username, password, avatar)
+    add_user(username, password_hasher.hash(password), avatar)
     return jsonify({'success': True, 'user': {'username': username, 'avatar': avatar}})
 
 @app.route('/api/login', methods=['POST'])
@@ -328,7 +540,7 @@ def login():
     username = data.get('username')
     password = data.get('password')
     user = get_user(username)
-    if not user or user['password'] != password:
+    if not user or not isinstance(password, str) or not check_password(user, password):
         return jsonify({'success': False, 'error': 'Invalid credentials'})
     set_user_online(username, True)
     return jsonify({'success': True, 'user': {'username': username, 'avatar': user['avatar']}})
@@ -342,7 +554,7 @@ def logout():
 
 @app.route('/api/users', methods=['GET'])
 def get_users():
-    users = get_all_users()
+    users = get_all_users_cached()
     return jsonify(users)
 
 @app.route('/api/messages', methods=['GET', 'POST'])
@@ -351,11 +563,13 @@ def chat_messages():
         username = request.args.get('username')
         if not username:
             return jsonify({'error': 'Missing username', 'conversations': [], 'unread': {}})
-        convs = get_conversations(username)
-        unread = {}
-        for m in convs:
-            if m['to'] == username and not m['read']:
-                unread[m['from']] = unread.get(m['from'], 0) + 1
+        try:
+            limit = int(request.args.get('limit', CONVERSATION_PAGE_SIZE))
+            offset = int(request.args.get('offset', 0))
+        except ValueError:
+            return jsonify({'error': 'Invalid limit or offset', 'conversations': [], 'unread': {}})
+        convs = get_conversations(username, request.args.get('peer'), limit, offset)
+        unread = get_unread_counts(username)
         return jsonify({'conversations': convs, 'unread': unread})
     else:
         data = request.json
@@ -364,9 +578,8 @@ def chat_messages():
         text = data.get('text')
         if not from_user or not to_user or not text:
             return jsonify({'success': False, 'error': 'Missing fields'})
-        add_message(from_user, to_user, text)
-        mark_messages_delivered(from_user, to_user)
-        socketio.emit('new_message', {
+        add_message(from_user, to_user, text, delivered=True)
+        queue_event('new_message', {
             'from': from_user,
             'to': to_user,
             'text': text
@@ -379,7 +592,7 @@ def mark_read():
     from_user = data.get('from')
     to_user = data.get('to')
     mark_messages_read(from_user, to_user)
-    socketio.emit('read_message', {'from': from_user, 'to': to_user})
+    queue_event('read_message', {'from': from_user, 'to': to_user})
     return jsonify({'success': True})
 
 # --- SocketIO events for user status (optional for monitor) ---
@@ -396,25 +609,52 @@ def user_offline(data):
     emit('user_status', {'username': username, 'online': False})
 
 # --- Monitor endpoint (still simulated relays, will update next) ---
+CDS_IP = '127.0.0.1'
+CDS_CLIENT_PORT = 9001
+RELAY_REFRESH_INTERVAL = 1.0  # seconds between background LIST_RELAYS polls
+relay_cache = {'ts': 0.0, 'relays': []}
+relay_cache_lock = threading.Lock()
+
+cds_conn = None  # kept open across polls; only used by the refresher task
+
+def fetch_relays_from_cds():
+    """Ask the CDS for every registered relay over the persistent LIST_RELAYS connection."""
+    global cds_conn
+    for attempt in range(2):
+        if cds_conn is None:
+            cds_conn = socket.create_connection((CDS_IP, CDS_CLIENT_PORT), timeout=1.5)
+        try:
+            send_frame(cds_conn, b'LIST_RELAYS')
+            return json_loads(recv_frame(cds_conn, MAX_CELL_SIZE))
+        except OSError:
+            # CDS restarted or dropped us: reconnect once before giving up
+            cds_conn.close()
+            cds_conn = None
+            if attempt:
+                raise
+
+def refresh_relays():
+    """Background task: poll the CDS every RELAY_REFRESH_INTERVAL and swap in the new list."""
+    while True:
+        try:
+            relays = fetch_relays_from_cds()
+        except Exception:
+            relays = []
+        with relay_cache_lock:
+            relay_cache['relays'] = relays
+            relay_cache['ts'] = time.monotonic()
+        socketio.sleep(RELAY_REFRESH_INTERVAL)
+
+def get_cached_relays():
+    """Return a copy of the latest relay snapshot; never touches the network."""
+    with relay_cache_lock:
+        return [dict(relay) for relay in relay_cache['relays']]
+
+socketio.start_background_task(refresh_relays)
+
 @app.route('/api/monitor', methods=['GET'])
 def monitor():
-    import random
-    relays = []
-    try:
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-            s.settimeout(1.5)
-            s.connect(("127.0.0.1", 9001))
-            s.sendall(b'LIST_RELAYS')
-            chunks = []
-            while True:
-                chunk = s.recv(4096)
-                if not chunk:
-                    break
-                chunks.append(chunk)
-            data = b''.join(chunks)
-            relays = json.loads(data.decode()) if data else []
-    except Exception as e:
-        relays = []
+    relays = get_cached_relays()
     # Only keep relays that have a running process
     filtered_relays = []
     for relay in relays:
@@ -435,16 +675,14 @@ def monitor():
             shown_relays = filtered_relays
     else:
         shown_relays = filtered_relays
-    users = get_all_users()
-    with sqlite3.connect(DB_PATH) as conn:
-        c = conn.cursor()
-        c.execute('SELECT sender, recipient, text, timestamp, relay_path FROM messages ORDER BY timestamp DESC LIMIT 5')
-        last_msgs = c.fetchall()
+    users = get_all_users_cached()
+    with read_conn() as conn:
+        last_msgs = conn.execute('SELECT sender, recipient, text, timestamp, relay_path FROM messages ORDER BY timestamp DESC LIMIT 5').fetchall()
     paths = []
     for m in last_msgs:
         relay_path = None
         try:
-            relay_path = json.loads(m[4]) if m[4] else None
+            relay_path = decode_relay_path(m[4])
         except Exception:
             relay_path = None
         # Only use relay_path if it is a valid, non-empty list of relay ip:port strings
@@ -476,9 +714,8 @@ def send():
         relay_data = call_tor_client_backend(sender, recipient, message, relay_count)
         relay_path = relay_data.get('hops') if relay_data else None
         # Always return the relay path as a list of ip:port strings in the API response
-        add_message(sender, recipient, message, relay_path)
-        mark_messages_delivered(sender, recipient)
-        socketio.emit('new_message', {
+        add_message(sender, recipient, message, relay_path, delivered=True)
+        queue_event('new_message', {
             'from': sender,
             'to': recipient,
             'text': message,
@@ -1,111 +1,175 @@
-import socket
-import threading
-import json
+import asyncio
+try:
+    import uvloop  # faster drop-in event loop; asyncio's default loop is the fallback
+except ImportError:
+    uvloop = None
+try:
+    import simdjson  # parses lazily, so reading a few keys skips building the whole dict
+except ImportError:
+    simdjson = None
 import random
 import hashlib
+import binascii
+import signal
+from net_utils import FRAME_HEADER, json_dumps, json_loads
 
 RELAY_REG_PORT = 9000  # Port for relays to register
 CLIENT_REQ_PORT = 9001  # Port for clients to request relays
+MAX_REQUEST_SIZE = 65536  # Largest request frame accepted before the connection is dropped
+PUBLIC_KEY_SIZE = 32  # Relays publish base64 of a raw X25519 public key
+
+# One parser is enough: every request is handled on the event loop thread
+registration_parser = simdjson.Parser() if simdjson else None
+
+def parse_registration(data):
+    """Pull only the fields the CDS keeps out of a relay (de)registration.
+
+    Raises ValueError unless ip is a string, port an int and public_key the
+    base64 of a 32-byte key.
+    Only str/int values leave this function: a simdjson Array or Object kept
+    anywhere would pin the shared parser's document and fail every later parse.
+    """
+    doc = registration_parser.parse(data) if simdjson else json_loads(data)
+    ip, port = doc['ip'], doc['port']
+    if not isinstance(ip, str) or not isinstance(port, int) or isinstance(port, bool):
+        raise ValueError("ip must be a string and port an integer")
+    relay_info = {'ip': ip, 'port': port}
+    if doc.get('deregister') is True:
+        relay_info['deregister'] = True
+    else:
+        public_key = doc['public_key']
+        if not isinstance(public_key, str) or len(binascii.a2b_base64(public_key)) != PUBLIC_KEY_SIZE:
+            raise ValueError(f"public_key must be base64 of a {PUBLIC_KEY_SIZE}-byte key")
+        relay_info['public_key'] = public_key
+    return relay_info
 
 class CentralDirectoryServer:
     def __init__(self):
-        self.relays = []  # List of dicts: {"ip": str, "port": int, "public_key": str}
-        self.lock = threading.Lock()
+        self.relays = {}  # (ip, port) -> {"ip": str, "port": int, "public_key": str}
+        self.relays_json = None  # Serialized LIST_RELAYS body, rebuilt after any change
+        self.fingerprints = {}  # (ip, port) -> BLAKE2b-128 of the raw public key, computed at registration
+        self.relay_bytes = {}  # (ip, port) -> the relay serialized once, spliced into replies
+        self.connections = {}  # writer -> task serving it, so shutdown can close them cleanly
 
     def start(self):
-        threading.Thread(target=self.relay_registration_server, daemon=True).start()
-        threading.Thread(target=self.client_request_server, daemon=True).start()
+        # Everything runs on one event loop thread, so the relay table needs no
+        # lock and no thread is spawned per connection
+        (uvloop.run if uvloop else asyncio.run)(self.serve())
+
+    async def serve(self):
+        shutdown = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        loop.add_signal_handler(signal.SIGINT, shutdown.set)
+        loop.add_signal_handler(signal.SIGTERM, shutdown.set)
+        servers = [
+            await self.listen(RELAY_REG_PORT, self.handle_relay_registration, "relay registrations"),
+            await self.listen(CLIENT_REQ_PORT, self.client_reply, "client requests"),
+        ]
         print(f"[CDS] Central Directory Server running on ports {RELAY_REG_PORT} (relay reg), {CLIENT_REQ_PORT} (client req)")
-        while True:
-            pass  # Keep main thread alive
+        await shutdown.wait()
+        for server in servers:
+            server.close()
+        # Callers such as the API server's relay refresher hold connections open;
+        # close them so their tasks end instead of being cancelled mid-read
+        for writer in list(self.connections):
+            writer.close()
+        await asyncio.gather(*self.connections.values(), return_exceptions=True)
+        print("[CDS] Shut down")
+
+    async def listen(self, port, handler, what):
+        server = await asyncio.start_server(
+            lambda reader, writer: self.serve_connection(reader, writer, handler),
+            "0.0.0.0", port, reuse_address=True)  # Accept connections from any interface
+        print(f"[CDS] Listening for {what} on 0.0.0.0:{port}")
+        return server
 
-    def relay_registration_server(self):
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-            s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-            s.bind(("0.0.0.0", RELAY_REG_PORT))  # Accept connections from any interface
-            s.listen()
-            print(f"[CDS] Listening for relay registrations on 0.0.0.0:{RELAY_REG_PORT}")
+    async def serve_connection(self, reader, writer, handler):
+        # Requests and replies are both length-prefixed frames, so callers can
+        # keep the connection open for several requests
+        addr = writer.get_extra_info('peername')
+        self.connections[writer] = asyncio.current_task()
+        try:
             while True:
-                conn, addr = s.accept()
-                threading.Thread(target=self.handle_relay_registration, args=(conn, addr), daemon=True).start()
+                (length,) = FRAME_HEADER.unpack(await reader.readexactly(FRAME_HEADER.size))
+                if length > MAX_REQUEST_SIZE:
+                    print(f"[CDS] Dropping {addr}: {length}-byte request exceeds {MAX_REQUEST_SIZE}")
+                    return
+                reply = handler(await reader.readexactly(length), addr)
+                writer.writelines((FRAME_HEADER.pack(len(reply)), reply))
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass  # peer closed the connection
+        finally:
+            self.connections.pop(writer, None)
+            writer.close()
 
-    def handle_relay_registration(self, conn, addr):
+    def handle_relay_registration(self, data, addr):
         try:
-            data = conn.recv(8192)
-            relay_info = json.loads(data.decode())
+            relay_info = parse_registration(data)
             # Support deregistration
+            key = (relay_info['ip'], relay_info['port'])
             if relay_info.get('deregister'):
-                with self.lock:
-                    self.relays = [r for r in self.relays if not (r['ip'] == relay_info['ip'] and r['port'] == relay_info['port'])]
-                    print(f"[CDS] Deregistered relay: {relay_info['ip']}:{relay_info['port']}")
-                conn.sendall(b'OK')
-                return
-            with self.lock:
-                # Check for duplicate (by ip/port)
-                found = False
-                for r in self.relays:
-                    if r["ip"] == relay_info["ip"] and r["port"] == relay_info["port"]:
-                        if r["public_key"] != relay_info["public_key"]:
-                            print(f"[CDS] Relay {relay_info['ip']}:{relay_info['port']} public key updated.")
-                            r["public_key"] = relay_info["public_key"]
-                        else:
-                            print(f"[CDS] Relay already registered: {relay_info}")
-                        found = True
-                        break
-                if not found:
-                    self.relays.append(relay_info)
-                    print(f"[CDS] Registered relay: {relay_info}")
-            conn.sendall(b'OK')
+                self.relays.pop(key, None)
+                self.fingerprints.pop(key, None)
+                self.relay_bytes.pop(key, None)
+                self.relays_json = None
+                print(f"[CDS] Deregistered relay: {relay_info['ip']}:{relay_info['port']}")
+                return b'OK'
+            # Check for duplicate (by ip/port)
+            existing = self.relays.get(key)
+            if existing is None:
+                self.store_relay(key, relay_info)
+                print(f"[CDS] Registered relay: {relay_info}")
+            elif existing["public_key"] != relay_info["public_key"]:
+                print(f"[CDS] Relay {relay_info['ip']}:{relay_info['port']} public key updated.")
+                self.store_relay(key, relay_info)
+            else:
+                print(f"[CDS] Relay already registered: {relay_info}")
+            return b'OK'
         except Exception as e:
             print(f"[CDS] Relay registration error from {addr}: {e}")
-            conn.sendall(b'ERROR')
-        finally:
-            conn.close()
+            return b'ERROR'
 
-    def client_request_server(self):
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-            s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-            s.bind(("0.0.0.0", CLIENT_REQ_PORT))  # Accept connections from any interface
-            s.listen()
-            print(f"[CDS] Listening for client requests on 0.0.0.0:{CLIENT_REQ_PORT}")
-            while True:
-                conn, addr = s.accept()
-                threading.Thread(target=self.handle_client_request, args=(conn, addr), daemon=True).start()
+    def store_relay(self, key, relay_info):
+        # Work out everything that can fail before touching the tables, so a bad
+        # key leaves the relay either fully stored or exactly as it was
+        # Same digest as crypto_utils.public_key_fingerprint, so CDS, relay and client logs agree
+        fingerprint = hashlib.blake2b(binascii.a2b_base64(relay_info['public_key']), digest_size=16).hexdigest()
+        relay_bytes = json_dumps(relay_info)
+        self.relays[key] = relay_info
+        self.fingerprints[key] = fingerprint
+        self.relay_bytes[key] = relay_bytes
+        self.relays_json = None
 
-    def handle_client_request(self, conn, addr):
+    def client_reply(self, data, addr):
         try:
-            data = conn.recv(1024)
             req = data.decode().strip()
-            n = 3
             if req == 'LIST_RELAYS':
-                with self.lock:
-                    conn.sendall(json.dumps(self.relays).encode())
-                print(f"[CDS] Provided LIST_RELAYS to {addr}: {self.relays}")
-                return
-            if req.startswith('REQUEST_RELAYS:'):
-                try:
-                    n = int(req.split(':')[1])
-                except Exception:
-                    n = 3
+                if self.relays_json is None:
+                    self.relays_json = b'[' + b','.join(self.relay_bytes.values()) + b']'
+                print(f"[CDS] Provided LIST_RELAYS to {addr}: {len(self.relays_json)} bytes")
+                return self.relays_json
             if req.startswith('REQUEST_RELAYS'):
-                with self.lock:
-                    if len(self.relays) < n:
-                        conn.sendall(b'NOT_ENOUGH_RELAYS')
-                        return
-                    selected = random.sample(self.relays, n)
-                conn.sendall(json.dumps(selected).encode())
-                import hashlib
-                for relay in selected:
-                    fingerprint = hashlib.sha256(relay['public_key'].encode()).hexdigest()
-                    print(f"[CDS] [KEY] Sending relay public key fingerprint: {fingerprint} for {relay['ip']}:{relay['port']}")
-                print(f"[CDS] Provided relays to client {addr}: {selected}")
-                return
-            conn.sendall(b'ERROR')
+                n = 3
+                if req.startswith('REQUEST_RELAYS:'):
+                    try:
+                        n = int(req.split(':')[1])
+                    except Exception:
+                        n = 3
+                if len(self.relays) < n:
+                    return b'NOT_ENOUGH_RELAYS'
+                keys = list(self.relays)
+                if n == len(keys):
+                    random.shuffle(keys)  # the usual 3-of-3 case: just reorder every relay
+                else:
+                    keys = random.sample(keys, n)
+                fingerprints = ', '.join(f"{ip}:{port}={self.fingerprints[(ip, port)]}" for ip, port in keys)
+                print(f"[CDS] [KEY] Provided relays to client {addr}: {fingerprints}")
+                return b'[' + b','.join(self.relay_bytes[key] for key in keys) + b']'
+            return b'ERROR'
         except Exception as e:
             print(f"[CDS] Client request error from {addr}: {e}")
-            conn.sendall(b'ERROR')
-        finally:
-            conn.close()
+            return b'ERROR'
 
 if __name__ == "__main__":
     cds = CentralDirectoryServer()
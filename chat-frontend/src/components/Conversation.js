@@ -61,7 +61,7 @@ export default function Conversation({ currentUser, peerUser, conversations, set
     const data = await res.json();
     if (data.success) {
       // Optionally, fetch updated conversations after sending
-      fetch(`/api/messages?username=${encodeURIComponent(currentUser.username)}`)
+      fetch(`/api/messages?username=${encodeURIComponent(currentUser.username)}&peer=${encodeURIComponent(peerUser.username)}`)
         .then(r => r.json())
         .then(data => {
           setConversations(data.conversations || []);
@@ -27,7 +27,7 @@ export default function ChatPage() {
     setCurrentUser(user);
     fetch('/api/users').then(r => r.json()).then(setUsers);
     if (selectedUser) {
-      fetch(`/api/messages?username=${encodeURIComponent(user.username)}`)
+      fetch(`/api/messages?username=${encodeURIComponent(user.username)}&peer=${encodeURIComponent(selectedUser.username)}`)
         .then(r => r.json())
         .then(data => {
           setConversations(
@@ -58,8 +58,8 @@ export default function ChatPage() {
     };
     socket.on("new_message", handleNewMessage);
     socket.on("read_message", (msg) => {
-      if (msg.to === currentUser.username || msg.from === currentUser.username) {
-        fetch(`/api/messages?username=${encodeURIComponent(currentUser.username)}`)
+      if (selectedUser && (msg.to === currentUser.username || msg.from === currentUser.username)) {
+        fetch(`/api/messages?username=${encodeURIComponent(currentUser.username)}&peer=${encodeURIComponent(selectedUser.username)}`)
           .then(r => r.json())
           .then(data => {
             setConversations(data.conversations || []);
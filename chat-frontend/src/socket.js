@@ -4,3 +4,11 @@ const URL = process.env.NODE_ENV === "production" ? undefined : "http://localhos
 export const socket = io(URL, {
   autoConnect: false
 });
+
+// The server coalesces chat events into "events_batch" packets of [name, payload]
+// pairs; replay each one so components can keep listening with socket.on(name).
+socket.on("events_batch", (events) => {
+  events.forEach(([name, payload]) => {
+    socket.listeners(name).forEach((listener) => listener(payload));
+  });
+});
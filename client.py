@@ -1,147 +1,148 @@
 import socket
-import json
 import base64
-from crypto_utils import generate_aes_key, aes_encrypt, aes_decrypt, deserialize_public_key, rsa_encrypt, public_key_fingerprint
-import hashlib
+from net_utils import json_loads, send_frame, recv_frame, MAX_CELL_SIZE, pack_layer, LAYER_RELAY, LAYER_EXIT
+from crypto_utils import seal_cell, aead_decrypt, deserialize_public_key, public_key_fingerprint
 import argparse
+import logging
 
 CDS_DEFAULT_IP = '127.0.0.1'
 CDS_CLIENT_PORT = 9001
+CLIENT_TIMEOUT = 10  # seconds to wait for a message to traverse the relays
+
+logger = logging.getLogger(__name__)
 
 class Client:
     def __init__(self, dest_ip, dest_port, message, cds_ip=CDS_DEFAULT_IP):
-        # Ensure message is valid JSON
-        import json
+        # Ensure message is valid JSON; once it is, it goes to the destination as-is
         try:
-            json.loads(message)
+            json_loads(message)
         except Exception as e:
-            print(f"[Client] ERROR: Message must be a valid JSON string. Got: {message}\nError: {e}")
-            exit(1)
+            raise ValueError(f"Message must be a valid JSON string. Got: {message}\nError: {e}")
         self.dest_ip = dest_ip
         self.dest_port = dest_port
         self.message = message.encode()
         self.cds_ip = cds_ip
+        # Structured trace of the last run, returned to in-process callers
+        self.layers = []
+        self.steps = []
+        # Parsed public key and fingerprint per relay of the current path
+        self.pubkeys = []
+        self.fingerprints = []
 
     def get_relays_from_cds(self, n=3):
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-            s.connect((self.cds_ip, CDS_CLIENT_PORT))
+        with socket.create_connection((self.cds_ip, CDS_CLIENT_PORT), timeout=CLIENT_TIMEOUT) as s:
             req = f'REQUEST_RELAYS:{n}'.encode()
-            s.sendall(req)
-            data = s.recv(65536)
+            send_frame(s, req)
+            data = recv_frame(s, MAX_CELL_SIZE)
             if data == b'NOT_ENOUGH_RELAYS':
                 raise Exception('Not enough relays registered!')
-            relays = json.loads(data.decode())
-            for relay in relays:
-                pubkey_obj = deserialize_public_key(relay['public_key'].encode())
-                print(f"[Client] Relay {relay['ip']}:{relay['port']} public key fingerprint: {public_key_fingerprint(pubkey_obj)}")
+            relays = json_loads(data)
+            # Parse each relay's key once; build_onion and the logs reuse it
+            self.pubkeys = [deserialize_public_key(relay['public_key']) for relay in relays]
+            self.fingerprints = [public_key_fingerprint(pubkey_obj) for pubkey_obj in self.pubkeys]
+            for relay, fingerprint in zip(relays, self.fingerprints):
+                logger.info("[Client] Relay %s:%s public key fingerprint: %s", relay['ip'], relay['port'], fingerprint)
             return relays
 
     def build_onion(self, relays):
-        # Print fingerprints for public keys used in onion layers
-        for i, relay in enumerate(relays):
-            pubkey_obj = deserialize_public_key(relay['public_key'].encode())
-            print(f"[Client] Using relay {relay['ip']}:{relay['port']} public key fingerprint for layer {i+1}: {public_key_fingerprint(pubkey_obj)}")
+        # Log fingerprints for public keys used in onion layers
+        if logger.isEnabledFor(logging.DEBUG):
+            for i, relay in enumerate(relays):
+                logger.debug("[Client] Using relay %s:%s public key fingerprint for layer %d: %s", relay['ip'], relay['port'], i + 1, self.fingerprints[i])
         N = len(relays)
-        session_keys = [generate_aes_key() for _ in range(N)]
-        # Prepare innermost payload: always valid JSON, UTF-8 bytes
-        try:
-            innermost_json = json.loads(self.message.decode('utf-8') if isinstance(self.message, bytes) else self.message)
-        except Exception:
-            innermost_json = {"msg": self.message.decode('utf-8') if isinstance(self.message, bytes) else self.message}
-        payload = json.dumps(innermost_json, ensure_ascii=False).encode('utf-8')
-        print(f"[Client] [DEBUG] Innermost payload to destination: {payload!r}")
-        # Build onion from innermost to outermost
+        self.layers = [f"Layer {N - i} (relay {relay['ip']}:{relay['port']})" for i, relay in enumerate(relays)]
+        self.layers.append(f"Destination: {self.dest_ip}:{self.dest_port}")
+        layer_ciphers = [None] * N
+        # Innermost payload: the message validated in __init__, UTF-8 bytes
+        payload = self.message
+        logger.debug("[Client] Innermost payload to destination: %r", payload)
+        # Build onion from innermost to outermost: relay i's layer names the hop
+        # after it, and the last relay's layer names the destination
         for i in reversed(range(N)):
-            pubkey_obj = deserialize_public_key(relays[i]['public_key'].encode())
-            session_key = session_keys[i]
-            session_key_enc = base64.b64encode(rsa_encrypt(pubkey_obj, session_key)).decode('utf-8')
-            # Encrypt payload with AES session key
-            encrypted_payload = aes_encrypt(session_key, payload)
-            payload_b64 = base64.b64encode(encrypted_payload).decode('utf-8')
-            # Build envelope for this layer
-            next_ip = relays[i]['ip'] if i < N - 1 else self.dest_ip
-            next_port = relays[i]['port'] if i < N - 1 else self.dest_port
-            layer = {
-                'next_ip': next_ip,
-                'next_port': next_port,
-                'session_key': session_key_enc,
-                'payload': payload_b64
-            }
-            payload = json.dumps(layer).encode('utf-8')
-            print(f"[Client] [DEBUG] Layer {i+1} envelope: {payload!r}")
-        print(f"[Client] [DEBUG] Final onion payload: {payload!r}, len={len(payload)}")
-        print(f"[Client] [DEBUG] Sending to first relay {relays[0]['ip']}:{relays[0]['port']}, len={len(payload)}, type={type(payload)}")
-        return payload, relays[0]['ip'], relays[0]['port'], session_keys
+            if i == N - 1:
+                layer = pack_layer(LAYER_EXIT, self.dest_ip, self.dest_port, payload)
+            else:
+                layer = pack_layer(LAYER_RELAY, relays[i + 1]['ip'], relays[i + 1]['port'], payload)
+            # Each layer's key comes from an X25519 exchange with that relay
+            layer_ciphers[i], payload = seal_cell(self.pubkeys[i], layer)
+            logger.debug("[Client] Layer %d cell: len=%d", i + 1, len(payload))
+        logger.debug("[Client] Sending to first relay %s:%s, len=%d", relays[0]['ip'], relays[0]['port'], len(payload))
+        return payload, relays[0]['ip'], relays[0]['port'], layer_ciphers
 
-    def send_onion(self, onion_bytes, first_ip, first_port, keys):
-        import socket
-        import base64
-        import json
+    def send_onion(self, onion_bytes, first_ip, first_port, ciphers):
         # Send to first relay (outermost layer)
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-            s.connect((first_ip, first_port))
-            s.sendall(onion_bytes)
-            response = s.recv(65536)
-        print(f"[Client] [DEBUG] Received response from first relay: type={type(response)}, len={len(response)}, preview={response[:60]!r}")
+        # The timeout bounds every connect/recv, so a stalled circuit can't pin
+        # the caller's thread (api_server runs this on a small worker pool)
+        with socket.create_connection((first_ip, first_port), timeout=CLIENT_TIMEOUT) as s:
+            # The whole frame goes out in one sendall; don't let Nagle hold back its tail
+            s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            send_frame(s, onion_bytes)
+            response = recv_frame(s, MAX_CELL_SIZE)
+        logger.debug("[Client] Received response from first relay: len=%d, preview=%r", len(response), response[:60])
         # Unwrap each layer
         response_layer = response
-        for i, key in enumerate(keys):
-            # Only base64-decode if the response is base64-encoded (i.e., not plaintext JSON error)
+        for i, cipher in enumerate(ciphers):
+            # A relay that failed answers with plaintext JSON instead of a sealed layer
             try:
-                # Try to decode as utf-8 and parse as JSON
                 as_str = response_layer.decode('utf-8')
                 if as_str.strip().startswith('{'):
                     # Looks like JSON, stop unwrapping and print result
-                    print(f"[Client] [RESULT] {as_str}")
-                    return
+                    logger.info("[Client] [RESULT] %s", as_str)
+                    self.steps.append(f"Response received unencrypted after {i} layer(s).")
+                    return as_str
             except Exception:
                 pass
-            # If not JSON, assume it is base64-encoded and encrypted
             try:
-                response_layer = base64.b64decode(response_layer)
+                response_layer = aead_decrypt(cipher, response_layer)
             except Exception as e:
-                print(f"[Client] [ERROR] Base64 decode failed at layer {i}: {e}")
-                print(f"[Client] [RESULT] Raw response: {repr(response_layer)}")
-                return
-            print(f"[Client] [DEBUG] Received base64-decoded response: type={type(response_layer)}, len={len(response_layer)}, preview={response_layer[:60]!r}")
-            print(f"[Client] [DEBUG] Before aes_decrypt at layer {i}: type={type(response_layer)}, len={len(response_layer)}, preview='{repr(response_layer)[:60]}'")
-            response_layer = aes_decrypt(key, response_layer)
-            print(f"[Client] [DEBUG] After decrypt at layer {i}: type={type(response_layer)}, len={len(response_layer)}, preview={response_layer[:60]!r}")
-            print(f"[Client] [DEBUG] After decrypt at layer {i} (hex): {response_layer.hex()}")
-            print(f"[Client] [DEBUG] Passed raw bytes to next decryption at layer {i}, type={type(response_layer)}, len={len(response_layer)}")
-        print(f"[Client] [DEBUG] Final decrypted bytes: {repr(response_layer)}, len={len(response_layer)}")
-        print(f"[Client] [DEBUG] Final decrypted bytes (hex): {response_layer.hex()}")
+                logger.error("[Client] Decrypt failed at layer %d: %s; raw response: %r", i, e, response_layer[:60])
+                self.steps.append(f"Decrypt failed at layer {i + 1}.")
+                return None
+            self.steps.append(f"Layer {i+1} decrypted with relay {i+1} session key.")
+            logger.debug("[Client] After decrypt at layer %d: len=%d, preview=%r", i, len(response_layer), response_layer[:60])
         final_payload = response_layer
         # Final layer: print or return the result
         try:
             final_str = final_payload.decode('utf-8')
-            print(f"[Client] [DEBUG] Final decoded as UTF-8: {final_str}")
             try:
-                resp_json = json.loads(final_str)
-                print(f"[Client] [RESULT] {resp_json}")
+                resp_json = json_loads(final_str)
+                logger.info("[Client] [RESULT] %s", resp_json)
             except Exception:
-                print(f"[Client] [RESULT] {final_str}")
+                logger.info("[Client] [RESULT] %s", final_str)
+            self.steps.append("Response decoded as UTF-8.")
+            return final_str
         except Exception as e:
             # Try to base64 decode if encoding is present
             try:
                 final_str = final_payload.decode('utf-8', errors='ignore')
-                print(f"[Client] [DEBUG] Final decoded as UTF-8 (ignore errors): {final_str}")
-                resp_json = json.loads(final_str)
+                resp_json = json_loads(final_str)
                 if resp_json.get('encoding') == 'base64':
-                    import base64
                     decoded = base64.b64decode(resp_json['echo'])
-                    print(f"[Client] [RESULT] (base64 decoded): {decoded}")
+                    logger.info("[Client] [RESULT] (base64 decoded): %s", decoded)
                 else:
-                    print(f"[Client] [RESULT] {resp_json}")
+                    logger.info("[Client] [RESULT] %s", resp_json)
+                self.steps.append("Response decoded after ignoring invalid UTF-8.")
+                return final_str
             except Exception as e2:
-                print(f"[Client] [ERROR] Final layer not UTF-8 decodable: {e}")
-                print(f"[Client] [DEBUG] Final raw bytes repr: {repr(final_payload)}")
-                print(f"[Client] [DEBUG] Final raw bytes (hex): {final_payload.hex()}")
+                logger.error("[Client] Final layer not UTF-8 decodable: %s; raw bytes: %r", e, final_payload)
+                return None
 
     def run(self, path_length=3):
+        self.steps = []
         relays = self.get_relays_from_cds(path_length)
-        onion_bytes, first_ip, first_port, keys = self.build_onion(relays)
-        self.send_onion(onion_bytes, first_ip, first_port, keys)
+        onion_bytes, first_ip, first_port, ciphers = self.build_onion(relays)
+        response = self.send_onion(onion_bytes, first_ip, first_port, ciphers)
+        return {
+            'hops': [f"{r['ip']}:{r['port']}" for r in relays],
+            'layers': self.layers,
+            'steps': self.steps,
+            'response': response
+        }
+
+def send_message(dest_ip, dest_port, msg_json, path_length=3, cds_ip=CDS_DEFAULT_IP):
+    """Send msg_json through the relay network and return the structured trace."""
+    client = Client(dest_ip, dest_port, msg_json, cds_ip=cds_ip)
+    return client.run(path_length)
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Tor-inspired relay client")
@@ -150,7 +151,13 @@ if __name__ == "__main__":
     parser.add_argument("message", help="Message to send (must be valid JSON string)")
     parser.add_argument("--cds_ip", default=CDS_DEFAULT_IP, help="CDS server IP address (default: 127.0.0.1)")
     parser.add_argument("--path_length", type=int, default=3, help="Number of relays (default: 3)")
+    parser.add_argument("--debug", action="store_true", help="Log every layer as it is built and unwrapped")
     args = parser.parse_args()
+    logging.basicConfig(level=logging.DEBUG if args.debug else logging.INFO, format="%(message)s")
 
-    client = Client(args.dest_ip, args.dest_port, args.message, cds_ip=args.cds_ip)
+    try:
+        client = Client(args.dest_ip, args.dest_port, args.message, cds_ip=args.cds_ip)
+    except ValueError as e:
+        logger.error("[Client] %s", e)
+        exit(1)
     client.run(args.path_length)
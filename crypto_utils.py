@@ -1,83 +1,132 @@
 import os
-from cryptography.hazmat.primitives.asymmetric import rsa, padding
+import functools
+import hashlib
+from cryptography.hazmat.primitives.asymmetric import x25519
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
 from cryptography.hazmat.primitives import serialization, hashes
-from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
-from cryptography.hazmat.backends import default_backend
-import base64
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM, ChaCha20Poly1305
+import binascii
 import re
 
-# RSA Utilities
+# Key Agreement Utilities
+# Relays hold a long-term X25519 key. For each layer the client runs an
+# ephemeral-static X25519 exchange and derives that layer's AES key with HKDF,
+# so only the 32-byte ephemeral public key travels on the wire (RSA-OAEP
+# needed a 256-byte wrapped key and a millisecond-scale private-key op per hop).
 
-def generate_rsa_keypair():
-    private_key = rsa.generate_private_key(
-        public_exponent=65537,
-        key_size=2048,
-        backend=default_backend()
-    )
+SESSION_KEY_INFO = b'onion-v1'
+
+def generate_x25519_keypair():
+    private_key = x25519.X25519PrivateKey.generate()
     public_key = private_key.public_key()
     return private_key, public_key
 
-def serialize_public_key(public_key):
-    return public_key.public_bytes(
-        encoding=serialization.Encoding.PEM,
-        format=serialization.PublicFormat.SubjectPublicKeyInfo
-    )
+def serialize_public_key(public_key) -> bytes:
+    # Published as base64 of the raw 32-byte key (44 bytes instead of ~113 of PEM)
+    return binascii.b2a_base64(public_key.public_bytes(
+        encoding=serialization.Encoding.Raw,
+        format=serialization.PublicFormat.Raw
+    ), newline=False)
 
-def deserialize_public_key(pem_data):
-    return serialization.load_pem_public_key(pem_data, backend=default_backend())
-
-def rsa_encrypt(public_key, message: bytes) -> bytes:
-    return public_key.encrypt(
-        message,
-        padding.OAEP(
-            mgf=padding.MGF1(algorithm=hashes.SHA256()),
-            algorithm=hashes.SHA256(),
-            label=None
-        )
-    )
+@functools.lru_cache(maxsize=256)
+def deserialize_public_key(data):
+    # Clients see the same few relay keys on every path; parse each one once
+    return x25519.X25519PublicKey.from_public_bytes(binascii.a2b_base64(data))
+
+def derive_session_key(shared_secret: bytes, encapsulated: bytes) -> bytes:
+    # Binding the ephemeral public key into the KDF ties the key to this exchange
+    return HKDF(algorithm=hashes.SHA256(), length=32, salt=None,
+                info=SESSION_KEY_INFO + encapsulated).derive(shared_secret)
 
-def rsa_decrypt(private_key, ciphertext: bytes) -> bytes:
-    return private_key.decrypt(
-        ciphertext,
-        padding.OAEP(
-            mgf=padding.MGF1(algorithm=hashes.SHA256()),
-            algorithm=hashes.SHA256(),
-            label=None
-        )
+def encapsulate_session_key(public_key):
+    """Return (session_key, encapsulated): a fresh AES key for public_key's holder and
+    the 32-byte ephemeral public key they need to derive it."""
+    ephemeral = x25519.X25519PrivateKey.generate()
+    encapsulated = ephemeral.public_key().public_bytes(
+        encoding=serialization.Encoding.Raw,
+        format=serialization.PublicFormat.Raw
     )
+    return derive_session_key(ephemeral.exchange(public_key), encapsulated), encapsulated
+
+def decapsulate_session_key(private_key, encapsulated: bytes) -> bytes:
+    peer = x25519.X25519PublicKey.from_public_bytes(encapsulated)
+    return derive_session_key(private_key.exchange(peer), encapsulated)
 
 def public_key_fingerprint(public_key) -> str:
-    """Return SHA-256 fingerprint of a public key (hex)."""
-    der = public_key.public_bytes(
-        encoding=serialization.Encoding.DER,
-        format=serialization.PublicFormat.SubjectPublicKeyInfo
+    """Return the BLAKE2b-128 fingerprint of a public key's raw bytes (hex)."""
+    raw = public_key.public_bytes(
+        encoding=serialization.Encoding.Raw,
+        format=serialization.PublicFormat.Raw
     )
-    digest = hashes.Hash(hashes.SHA256())
-    digest.update(der)
-    return digest.finalize().hex()
-
-# AES Utilities
-
-def generate_aes_key() -> bytes:
-    return os.urandom(32)  # AES-256
-
-def aes_encrypt(key: bytes, plaintext: bytes) -> bytes:
-    iv = os.urandom(16)
-    cipher = Cipher(algorithms.AES(key), modes.CFB(iv), backend=default_backend())
-    encryptor = cipher.encryptor()
-    ciphertext = encryptor.update(plaintext) + encryptor.finalize()
-    return iv + ciphertext
-
-def aes_decrypt(key: bytes, s: bytes) -> bytes:
-    # MUST be called with raw bytes (iv+ciphertext) - base64 decoding must be done outside this function
-    # Do NOT base64-decode here; input is already raw bytes from previous decryption layer
-    # Instead, expect s to be iv+ciphertext (raw bytes)
-    if not isinstance(s, bytes):
+    return hashlib.blake2b(raw, digest_size=16).hexdigest()
+
+# AEAD Utilities
+# Layers use AES-256-GCM where the CPU has AES instructions (OpenSSL's
+# AES-NI/PCLMULQDQ path) and ChaCha20-Poly1305 otherwise, since software AES is
+# slow and table-based. Both take a 32-byte key, a 12-byte nonce and append a
+# 16-byte tag, so a wrong key or tampered layer fails loudly either way.
+# Wire format: nonce (12 bytes) || ciphertext || tag (16 bytes).
+
+GCM_NONCE_SIZE = 12
+SUITE_AES_GCM = 0
+SUITE_CHACHA20_POLY1305 = 1
+AEAD_CIPHERS = {SUITE_AES_GCM: AESGCM, SUITE_CHACHA20_POLY1305: ChaCha20Poly1305}
+
+def have_aes_instructions() -> bool:
+    """True unless /proc/cpuinfo shows a CPU without the 'aes' flag."""
+    try:
+        with open('/proc/cpuinfo') as f:
+            for line in f:
+                # x86 lists 'flags', ARM lists 'Features'
+                if line.startswith(('flags', 'Features')):
+                    return 'aes' in line.split()
+    except OSError:
+        pass
+    return True  # no cpuinfo to go on (e.g. macOS): keep AES-GCM
+
+# The suite this process seals new layers with; every cell names its suite,
+# so peers that picked differently still interoperate
+DEFAULT_SUITE = SUITE_AES_GCM if have_aes_instructions() else SUITE_CHACHA20_POLY1305
+
+def aead(key: bytes, suite: int = DEFAULT_SUITE):
+    """Return the keyed cipher for one layer. seal_cell/open_cell hand it to their
+    caller, which reuses it for the response instead of keeping the key anywhere."""
+    return AEAD_CIPHERS[suite](key)
+
+def aead_encrypt(cipher, plaintext: bytes) -> bytes:
+    nonce = os.urandom(GCM_NONCE_SIZE)
+    return nonce + cipher.encrypt(nonce, plaintext, None)
+
+def aead_decrypt(cipher, s: bytes) -> bytes:
+    # MUST be called with raw bytes (nonce+ciphertext+tag) - base64 decoding must be done outside this function
+    if not isinstance(s, (bytes, bytearray, memoryview)):
         raise TypeError("Input must be bytes")
-    if len(s) < 16:
-        raise ValueError(f"Payload too short to be valid AES (len={len(s)}): {s}")
-    iv = s[:16]
-    ciphertext = s[16:]
-    cipher = Cipher(algorithms.AES(key), modes.CFB(iv), backend=default_backend())
-    decryptor = cipher.decryptor()
-    return decryptor.update(ciphertext) + decryptor.finalize()
+    if len(s) < GCM_NONCE_SIZE + 16:
+        raise ValueError(f"Payload too short to be a valid AEAD layer (len={len(s)}): {bytes(s)}")
+    view = memoryview(s)
+    return cipher.decrypt(view[:GCM_NONCE_SIZE], view[GCM_NONCE_SIZE:], None)
+
+# Onion Cells
+# A cell is the suite byte, the layer's 32-byte ephemeral public key, then the
+# sealed layer, so it travels as raw bytes with no base64 or JSON wrapping.
+
+X25519_KEY_SIZE = 32
+CELL_HEADER_SIZE = 1 + X25519_KEY_SIZE
+
+def seal_cell(public_key, plaintext: bytes, suite: int = DEFAULT_SUITE):
+    """Return (cipher, cell) with plaintext sealed for public_key's holder; the
+    cipher opens that holder's response."""
+    session_key, encapsulated = encapsulate_session_key(public_key)
+    cipher = aead(session_key, suite)
+    nonce = os.urandom(GCM_NONCE_SIZE)
+    # One join instead of building nonce||ciphertext and then copying it again
+    return cipher, b''.join((bytes((suite,)), encapsulated, nonce, cipher.encrypt(nonce, plaintext, None)))
+
+def open_cell(private_key, cell: bytes):
+    """Return (cipher, plaintext); the response goes back sealed with the same cipher."""
+    view = memoryview(cell)
+    suite = view[0]
+    if suite not in AEAD_CIPHERS:
+        raise ValueError(f"Unknown cell suite {suite}")
+    cipher = aead(decapsulate_session_key(private_key, bytes(view[1:CELL_HEADER_SIZE])), suite)
+    return cipher, aead_decrypt(cipher, view[CELL_HEADER_SIZE:])
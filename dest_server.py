@@ -1,11 +1,14 @@
-import socket
-import threading
+import asyncio
+try:
+    import uvloop  # faster drop-in event loop; asyncio's default loop is the fallback
+except ImportError:
+    uvloop = None
 import base64
 import re
 from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
 from cryptography.hazmat.primitives import padding
 import os
-import json
+from net_utils import FRAME_HEADER, MAX_CELL_SIZE, json_dumps, json_loads
 
 DEST_PORT = 9100
 
@@ -22,74 +25,45 @@ def encrypt_aes_128_cbc(plaintext, key):
     ct = encryptor.update(padded_data) + encryptor.finalize()
     return iv + ct
 
-def handle_client(conn, addr):
+def build_response(data, addr):
+    # Parse the raw bytes directly; base64 is only tried if that fails
     try:
-        data = conn.recv(65536)
-        if not data:
-            print(f"[DestServer] No data received from {addr}")
-            return
-        print(f"[DestServer] Received from {addr}: {data!r}, len={len(data)}, type={type(data)}")
         try:
-            # Try both raw bytes and utf-8 decode for maximum compatibility
-            try:
-                payload_str = data.decode('utf-8')
-                print(f"[DestServer] Decoded payload_str: {payload_str!r}")
-            except Exception as e:
-                print(f"[DestServer] ERROR: Could not decode as utf-8: {e}")
-                payload_str = None
-            # If utf-8 decode failed, try base64-decode then utf-8
-            if payload_str is None or not payload_str.strip().startswith('{'):
-                try:
-                    payload_bytes = base64.b64decode(data)
-                    payload_str = payload_bytes.decode('utf-8')
-                    print(f"[DestServer] Base64-decoded then utf-8 payload_str: {payload_str!r}")
-                except Exception as e:
-                    print(f"[DestServer] ERROR: Could not base64-decode or utf-8 decode: {e}")
-                    payload_str = None
-            if payload_str is not None:
-                try:
-                    payload_json = json.loads(payload_str)
-                    print(f"[DestServer] Parsed JSON: {payload_json}")
-                    # Build a response JSON
-                    response = {"result": "OK", "echo": payload_json}
-                    response_bytes = json.dumps(response).encode('utf-8')
-                    print(f"[DestServer] Response bytes (UTF-8 JSON): {response_bytes!r}")
-                    to_send = response_bytes
-                    print(f"[DestServer] Sending UTF-8 JSON response: {to_send!r}")
-                except Exception as e:
-                    print(f"[DestServer] ERROR: Could not parse JSON: {e}")
-                    error_message = f"ERROR: {str(e)}".encode('utf-8')
-                    # Wrap all errors in a JSON object for consistency
-                    error_json = json.dumps({"result": "ERROR", "error": str(e)}).encode('utf-8')
-                    to_send = error_json
-            else:
-                error_message = "ERROR: Could not decode payload as JSON."
-                error_json = json.dumps({"result": "ERROR", "error": error_message}).encode('utf-8')
-                to_send = error_json
-        except Exception as e:
-            print(f"[DestServer] ERROR: Invalid input: {e}\nPayload: {data}")
-            error_message = f"ERROR: {str(e)}".encode('utf-8')
-            error_json = json.dumps({"result": "ERROR", "error": str(e)}).encode('utf-8')
-            to_send = error_json
-        print(f"[DestServer] Sending back: {to_send!r}, len={len(to_send)}, type={type(to_send)}")
-        conn.sendall(to_send)
+            payload = json_loads(data)
+        except ValueError:
+            payload = json_loads(base64.b64decode(data, validate=True))
+        return json_dumps({"result": "OK", "echo": payload})
     except Exception as e:
-        print(f"[DestServer] Error with {addr}: {e}")
-        error_message = f"ERROR: {str(e)}".encode('utf-8')
-        error_json = json.dumps({"result": "ERROR", "error": str(e)}).encode('utf-8')
-        conn.sendall(error_json)
+        print(f"[DestServer] ERROR: Could not parse request from {addr} as JSON: {e}")
+        return json_dumps({"result": "ERROR", "error": str(e)})
+
+async def handle_client(reader, writer):
+    # One event loop thread serves every relay connection; requests and replies
+    # are length-prefixed frames, as everywhere else on the onion path
+    addr = writer.get_extra_info('peername')
+    try:
+        while True:
+            (length,) = FRAME_HEADER.unpack(await reader.readexactly(FRAME_HEADER.size))
+            if length > MAX_CELL_SIZE:
+                print(f"[DestServer] Dropping {addr}: {length}-byte request exceeds {MAX_CELL_SIZE}")
+                return
+            data = await reader.readexactly(length)
+            to_send = build_response(data, addr)
+            writer.writelines((FRAME_HEADER.pack(len(to_send)), to_send))
+            await writer.drain()
+    except (asyncio.IncompleteReadError, ConnectionError):
+        pass  # relay closed the connection
     finally:
-        conn.close()
+        writer.close()
+
+async def serve():
+    server = await asyncio.start_server(handle_client, "0.0.0.0", DEST_PORT, reuse_address=True)  # Accept connections from any interface
+    print(f"[DestServer] Listening on port {DEST_PORT}")
+    async with server:
+        await server.serve_forever()
 
 def start_dest_server():
-    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        s.bind(("0.0.0.0", DEST_PORT))  # Accept connections from any interface
-        s.listen()
-        print(f"[DestServer] Listening on port {DEST_PORT}")
-        while True:
-            conn, addr = s.accept()
-            threading.Thread(target=handle_client, args=(conn, addr), daemon=True).start()
+    (uvloop.run if uvloop else asyncio.run)(serve())
 
 if __name__ == "__main__":
     start_dest_server()
@@ -0,0 +1,70 @@
+import struct
+import json
+try:
+    import orjson  # much faster (de)serialization; stdlib json is the fallback
+except ImportError:
+    orjson = None
+
+# JSON Utilities
+# Every process on the onion path shares these, so they agree on one contract:
+# json_dumps returns UTF-8 bytes and json_loads accepts bytes or str.
+
+def json_dumps(obj) -> bytes:
+    return orjson.dumps(obj) if orjson else json.dumps(obj, ensure_ascii=False).encode('utf-8')
+
+def json_loads(data):
+    return orjson.loads(data) if orjson else json.loads(data)
+
+# Framing Utilities
+# A frame is a 4-byte big-endian length followed by that many payload bytes,
+# so a connection can carry several request/response pairs.
+
+FRAME_HEADER = struct.Struct('>I')
+MAX_CELL_SIZE = 4 * 1024 * 1024  # Largest onion cell or reply a hop will read; the header is peer-controlled
+
+def send_frame(sock, payload: bytes):
+    sock.sendall(FRAME_HEADER.pack(len(payload)) + payload)
+
+def recv_exact(sock, n: int) -> bytearray:
+    buf = bytearray(n)
+    view = memoryview(buf)
+    got = 0
+    while got < n:
+        received = sock.recv_into(view[got:], n - got)
+        if not received:
+            raise ConnectionError(f"Connection closed after {got} of {n} bytes")
+        got += received
+    return buf
+
+def recv_frame(sock, max_size=None) -> bytearray:
+    (length,) = FRAME_HEADER.unpack(recv_exact(sock, FRAME_HEADER.size))
+    # Check before recv_exact allocates the buffer the peer asked for
+    if max_size is not None and length > max_size:
+        raise ValueError(f"{length}-byte frame exceeds {max_size}")
+    return recv_exact(sock, length)
+
+# Onion Layer Utilities
+# A decrypted layer is kind (1 byte) || next port (2) || next ip length (1) ||
+# next ip || inner payload. A RELAY layer's payload is the next relay's cell;
+# an EXIT layer's payload is the message for the destination named in it.
+
+LAYER_HEADER = struct.Struct('>BHB')
+LAYER_RELAY = 0
+LAYER_EXIT = 1
+
+def pack_layer(kind: int, next_ip: str, next_port: int, inner: bytes) -> bytearray:
+    # Written in place so the inner cell, the bulk of the layer, is copied once
+    ip = next_ip.encode()
+    start = LAYER_HEADER.size + len(ip)
+    layer = bytearray(start + len(inner))
+    LAYER_HEADER.pack_into(layer, 0, kind, next_port, len(ip))
+    layer[LAYER_HEADER.size:start] = ip
+    layer[start:] = inner
+    return layer
+
+def unpack_layer(layer: bytes):
+    # The inner payload comes back as a view into layer, not a copy
+    kind, next_port, ip_len = LAYER_HEADER.unpack_from(layer)
+    start = LAYER_HEADER.size + ip_len
+    view = memoryview(layer)
+    return kind, bytes(view[LAYER_HEADER.size:start]).decode(), next_port, view[start:]